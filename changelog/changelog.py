@@ -1,18 +1,158 @@
 # !/usr/bin/env python
 import sys
 import os
+import itertools
+import operator
 import logging
+import hashlib
+import json
 import datetime
+import time
 import argparse
 import re
-
+import types
+import shutil
+import tempfile
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
 
-# regular expression for the "next page" link in Github search results
+# maximum number of results per page of the API
+PER_PAGE = 100
+
+# regular expressions for the "next page" link, and the number of the last page, in the "link" header of
+# paginated API responses
 RE_NEXT_LINK = re.compile(r'<(\S*)>; rel="next"', re.IGNORECASE)
+RE_LAST_PAGE = re.compile(r'<[^>]*[?&]page=(\d+)[^>]*>; rel="last"', re.IGNORECASE)
+
+# search terms which contain whitespace or double-quote characters need to be quoted (see `escape`)
+RE_NEEDS_QUOTES = re.compile(r'[\s"]')
+ESCAPE_QUOTES = str.maketrans({'"': r'\"'})
+
+# maximum number of requests sent to Github at the same time (Github discourages
+# many concurrent requests and may trigger its secondary rate limits)
+MAX_CONCURRENT_REQUESTS = 5
+
+# buffer size used when writing the changelog file
+WRITE_BUFFER_SIZE = 1 << 16
+
+# size of the chunks used to copy the rest of an existing changelog file
+COPY_BUFFER_SIZE = 1 << 20
+
+# directory of the on-disk cache of the API responses, shared by all the runs of the user
+CACHE_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                               'changelog-neuropoly')
+
+# age (in seconds) after which the cached API responses are dropped
+CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# GraphQL query listing the merged pull requests of a milestone along with their labels
+MILESTONE_PRS_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    milestone(number: $number) {
+      pullRequests(first: 100, states: MERGED, after: $cursor) {
+        pageInfo { hasNextPage endCursor }
+        nodes { number title url labels(first: 100) { nodes { name } } }
+      }
+    }
+  }
+}
+"""
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of the API responses, along with their `ETag` and `Last-Modified` headers, used to send
+    conditional requests. Github answers them with `304 Not Modified` (which doesn't count against the
+    rate limits) when the response didn't change since the previous run.
+    Entries older than max_age (in seconds) are ignored, and removed from the directory.
+    """
+
+    def __init__(self, directory, max_age):
+        self.directory = directory
+        self.max_age = max_age
+        self._pruned = False
+        self._writable = True
+
+    def _path(self, method, url, params):
+        key = json.dumps([method, url, sorted((params or {}).items())])
+        return os.path.join(self.directory, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.json")
+
+    def get(self, method, url, params):
+        """
+        Return the cached entry for a request, or None if it was never cached.
+        """
+        path = self._path(method, url, params)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _prune(self):
+        """
+        Remove the entries (and leftover temporary files) older than max_age.
+        """
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                if now - entry.stat().st_mtime > self.max_age:
+                    os.remove(entry.path)
+            except OSError:
+                # e.g. removed by another run at the same time
+                pass
+
+    def set(self, method, url, params, response):
+        """
+        Cache a response if it can be used for conditional requests.
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if (etag is None and last_modified is None) or not self._writable:
+            return
+
+        entry = {
+            'etag': etag,
+            'last_modified': last_modified,
+            'link': response.headers.get('link'),
+            'content': response.text,
+        }
+        # the cache is only an optimization, the run goes on without it if it can't be written
+        try:
+            self._write(self._path(method, url, params), entry)
+        except OSError as e:
+            self._writable = False
+            logger.warning(f"Could not write to the cache of the API responses, running without it: {e}")
+
+    def _write(self, path, entry):
+        """
+        Write an entry of the cache to path.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if not self._pruned:
+            self._pruned = True
+            self._prune()
+
+        # write to a temporary file first, so that concurrent runs never read a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
 
 
 class GithubAPI(object):
@@ -20,79 +160,135 @@ class GithubAPI(object):
     Simple wrapper around the github API that respects rate limiting and supports authentication.
     """
 
-    def __init__(self, repo_url):
+    __slots__ = ('_token', '_cache', 'authenticated', 'repo_url', 'api_url_prefix', '_session', '_rate_limits')
+
+    def __init__(self, repo_url, use_cache=True):
         self._token = os.environ.get('GITHUB_TOKEN', None)
+        self._cache = ResponseCache(CACHE_DIRECTORY, CACHE_MAX_AGE) if use_cache else None
+        self.authenticated = self._token is not None
         self.repo_url = repo_url
         self.api_url_prefix = "https://api.github.com"
-        self.check_rate_limit()
+        # re-use connections across requests, the pool is big enough for the concurrent requests
+        self._session = requests.Session()
+        self._session.mount(self.api_url_prefix, HTTPAdapter(pool_connections=1, pool_maxsize=10))
+        self._session.headers['Accept'] = 'application/json'
+        if self._token is not None:
+            self._session.headers['Authorization'] = f"token {self._token}"
+        # (remaining, reset) of each API rate limit, as given by the headers of the last response
+        self._rate_limits = {}
 
-    def check_rate_limit(self):
+    def _rate_limit_resource(self, url):
         """
+        Return the name of the API rate limit (as given by the `X-RateLimit-Resource` header) that a
+        request to url counts against.
+        """
+        if url.startswith(f"{self.api_url_prefix}/search/"):
+            return 'search'
+        if url == f"{self.api_url_prefix}/graphql":
+            return 'graphql'
+        return 'core'
+
+    def request(self, url, method="GET", headers=None, params=None, data=None, json_body=None):
+        """
+        Send a request to the API, unless the rate limit it counts against is known to be reached.
         API limits reset every hour so there is no point in spacing the requests over time
-        as the delays will make the script unusable. Instead check monitor the requests
-        remaining and notify user accordingly.
+        as the delays will make the script unusable. Instead monitor the requests remaining
+        (sent in the headers of every response) and notify user accordingly.
         It is recommended to use a PAT (personal access token) as this will increase the api
         limit for some resources.
         """
-        logger.info("Checking API rate limits:")
-
-        url = f"{self.api_url_prefix}/rate_limit"
-        r = self.request(url).json()
-
-        logger.debug(f"rate_limits: {r}")
-
-        core_api = r['resources']['core']
-        search_api = r['resources']['search']
-
-        logger.info(
-            f"Core api limit={core_api['limit']} remaining={core_api['remaining']} reset={datetime.datetime.fromtimestamp(core_api['reset'])}")
-        logger.info(
-            f"Search api limit={search_api['limit']} remaining={search_api['remaining']} reset={datetime.datetime.fromtimestamp(search_api['reset'])}")
-
-        if core_api['remaining'] == 0:
-            raise ValueError(f"Core API limit reached! Retry at {datetime.datetime.fromtimestamp(core_api['reset'])}")
-
-        if search_api['remaining'] == 0:
-            raise ValueError(
-                f"Search API limit reached! Retry at {datetime.datetime.fromtimestamp(search_api['reset'])}")
-
-    def request(self, url, method="GET", headers=None, params=None, data=None):
-        headers = headers or {}
-        if self._token is not None:
-            headers['Authorization'] = f"token {self._token}"
-        headers['Accept'] = 'application/json'
+        resource = self._rate_limit_resource(url)
+        if resource in self._rate_limits:
+            remaining, reset = self._rate_limits[resource]
+            if remaining == 0 and time.time() < reset:
+                raise ValueError(
+                    f"{resource.capitalize()} API limit reached! Retry at {datetime.datetime.fromtimestamp(reset)} "
+                    f"or use an authentication token!")
+
+        # the session headers (authentication, ...) are merged with the headers given here
+        headers = dict(headers) if headers else {}
+        cache = self._cache if method == "GET" else None
+        cached = cache.get(method, url, params) if cache is not None else None
+        if cached is not None:
+            if cached['etag'] is not None:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified'] is not None:
+                headers['If-Modified-Since'] = cached['last_modified']
 
         def callback(response, *args, **kwargs):
-            if not response.ok:
-                logger.error(f"Got a non 200 code from server: {response.status_code}: {response.json()}")
-                raise RuntimeError(response.status_code, response.json())
+            if response.status_code == 304:
+                logger.debug(f"Response not modified, using cached response for {response.url}")
+                # read the (empty) body first, so that the connection is released back to the pool
+                response.content
+                response.status_code = 200
+                response._content = cached['content'].encode('utf-8')
+                response.encoding = 'utf-8'
+                if cached['link'] is not None:
+                    response.headers['link'] = cached['link']
+            elif cache is not None and response.ok:
+                cache.set(method, url, params, response)
 
             limit = response.headers.get('X-RateLimit-Limit')
-            remaining = response.headers.get('X-RateLimit-Limit')
+            remaining = response.headers.get('X-RateLimit-Remaining')
             reset = response.headers.get('X-RateLimit-Reset')
+            if remaining is not None and reset is not None:
+                self._rate_limits[response.headers.get('X-RateLimit-Resource', resource)] = (int(remaining), int(reset))
+                logger.debug(
+                    f"api rate limit stats: resource={resource}, limit={limit}, remaining={remaining}, "
+                    f"reset={datetime.datetime.fromtimestamp(int(reset))}")
 
-            logger.debug(
-                f"api rate limit stats: limit={limit}, remaining={remaining}, reset={datetime.datetime.fromtimestamp(int(reset))}")
-
-            if remaining == 0:
-                raise ValueError(
-                    f"API limit reached! Retry at {datetime.datetime.fromtimestamp(reset)} or use an authentication token!")
+            if not response.ok:
+                logger.error(f"Got a non 200 code from server: {response.status_code}: {response.json()}")
+                raise RuntimeError(response.status_code, response.json())
 
-        return requests.request(
+        return self._session.request(
             method=method,
             url=url,
             headers=headers,
             params=params,
             data=data,
+            json=json_body,
             hooks={'response': callback}
         )
 
+    def request_json(self, url, **kwargs):
+        """
+        Send a request to the API and return the decoded JSON response.
+        """
+        return orjson.loads(self.request(url, **kwargs).content)
+
+    def request_pages(self, url, params=None):
+        """
+        Yield the decoded JSON responses of all the pages of a paginated API endpoint, in order.
+        The number of pages is given by the "last" link of the first page, so the other pages are
+        fetched concurrently. Otherwise the "next" links are followed one page after the other.
+        """
+        params = params or {}
+        response = self.request(url, params=params)
+        yield orjson.loads(response.content)
+
+        link = response.headers.get('link', '')
+        last_page = RE_LAST_PAGE.search(link)
+        if last_page:
+            def fetch_page(page):
+                return self.request_json(url, params={**params, 'page': page})
+
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+                yield from executor.map(fetch_page, range(2, int(last_page[1]) + 1))
+        else:
+            next_url = parse_next_link(link)
+            while next_url:
+                response = self.request(url=next_url)
+                yield orjson.loads(response.content)
+                next_url = parse_next_link(response.headers.get('link', ''))
+
     def fetch_open_milestones(self):
         """
         Fetch list of milestone dicts. Each dict contains metadata about an open milestone.
         """
         url = f"{self.api_url_prefix}/repos/{self.repo_url}/milestones"
-        open_milestones = self.request(url, params={"per_page": 100}).json()
+        pages = self.request_pages(url, params={"state": "open", "per_page": PER_PAGE})
+        open_milestones = [milestone for page in pages for milestone in page]
         if not open_milestones:
             raise ValueError("No open milestone was found on github.")
         logger.debug(f"Open milestones found: {open_milestones}")
@@ -102,6 +298,7 @@ class GithubAPI(object):
         """
         Get info about the most recently updated milestone.
         """
+        # NB: the milestones can't be sorted by update date by the API (only by due date or completeness)
         open_milestones = self.fetch_open_milestones()
         milestone = max(open_milestones, key=lambda m: m['updated_at'])
         logger.info(f"Using most recently updated milestone: '{milestone['title']}'")
@@ -125,45 +322,95 @@ class GithubAPI(object):
         Return the Github URL comparing the last tag with the new_tag.
         """
         url = f"{self.api_url_prefix}/repos/{self.repo_url}/releases"
-        r = self.request(url).json()
+        # releases are sorted by creation date, only the most recent one is needed
+        r = self.request_json(url, params={"per_page": 1})
         previous_tag = r[0]['tag_name']
         return f"https://github.com/{self.repo_url}/compare/{previous_tag}...{new_tag}"
 
+    def fetch_milestone_prs_graphql(self, milestone):
+        """
+        Yield the merged pull requests linked to the milestone provided, fetched with a single
+        (paginated) GraphQL query. The items are converted to the format of the search API results.
+        Note that the GraphQL API is only available to authenticated users.
+        """
+        url = f"{self.api_url_prefix}/graphql"
+        owner, name = self.repo_url.split('/')
+        variables = {'owner': owner, 'name': name, 'number': milestone['number'], 'cursor': None}
+
+        count = 0
+        while True:
+            r = self.request_json(url, method="POST", json_body={'query': MILESTONE_PRS_QUERY, 'variables': variables})
+            if 'errors' in r:
+                logger.error(f"Got an error from the GraphQL API: {r['errors']}")
+                raise RuntimeError(r['errors'])
+
+            pull_requests = r['data']['repository']['milestone']['pullRequests']
+            count += len(pull_requests['nodes'])
+            for node in pull_requests['nodes']:
+                yield {
+                    'number': node['number'],
+                    'title': node['title'],
+                    'html_url': node['url'],
+                    'labels': node['labels']['nodes'],
+                }
+
+            if pull_requests['pageInfo']['hasNextPage']:
+                variables['cursor'] = pull_requests['pageInfo']['endCursor']
+            else:
+                break
+
+        logger.info(f"Milestone: {milestone['title']}, Count: {count}")
+
     def search(self, milestone, label=None):
         """
-        Return a list of merged pull requests linked to the milestone and label provided.
+        Yield the merged pull requests linked to the milestone (and label, if provided), one page
+        of results at a time.
         """
         url = f"{self.api_url_prefix}/search/issues"
-        query = ' '.join(f'{op}:{escape(val)}' for op, val in [
+        qualifiers = [
             ('milestone', milestone),
             ('is', 'pr'),
             ('repo', self.repo_url),
             ('state', 'closed'),
             ('is', 'merged'),
-            ('no', 'label') if label is None else ('label', label),
-        ])
+        ]
+        if label is not None:
+            qualifiers.append(('label', label))
+        query = ' '.join(f'{op}:{escape(val)}' for op, val in qualifiers)
         payload = {'q': query,
-                   'per_page': 100,
-                   'page': 0}
+                   'per_page': PER_PAGE,
+                   'page': 1}
 
-        items = []
-        response = self.request(url=url, params=payload)
-        while True:
-            items.extend(response.json()['items'])
-            next_link = RE_NEXT_LINK.search(response.headers.get('link', ''))
-            if next_link:
-                response = self.request(url=next_link[1])
-            else:
-                break
+        count = 0
+        for page in self.request_pages(url, params=payload):
+            count += len(page['items'])
+            yield from page['items']
+
+        logger.info(f"Milestone: {milestone}, Label: {label}, Count: {count}")
+
+
+def parse_next_link(link):
+    """
+    Return the url of the "next page" link in the "link" header of a paginated API response, or None
+    if there is no next page.
+    """
+    # fast path for the format used by Github, the regular expression handles other spellings
+    end = link.find('>; rel="next"')
+    if end != -1:
+        start = link.rfind('<', 0, end)
+        if start != -1:
+            return link[start + 1:end]
+    elif 'next' not in link.lower():
+        return None
 
-        logger.info(f"Milestone: {milestone}, Label: {label}, Count: {len(items)}")
-        return items
+    next_link = RE_NEXT_LINK.search(link)
+    return next_link[1] if next_link else None
 
 
 def escape(string):
     r"""
     Quote and escape a search term used in a Github search query, if it
-    contains a space or a double-quote character.
+    contains whitespace or a double-quote character.
 
     Note that only double-quote characters need to be escaped, *not* backslash
     characters. So instead of the usual sequence of escapes, which roughly
@@ -175,39 +422,83 @@ def escape(string):
 
     " -> \" -> \\" -> \\\" -> ...
     """
-    if ' ' in string or '"' in string:
-        string = string.replace('"', r'\"')
-        string = f'"{string}"'
+    if RE_NEEDS_QUOTES.search(string):
+        return f'"{string.translate(ESCAPE_QUOTES)}"'
     return string
 
 
+def sort_by_label(items, labels):
+    """
+    Group items (PRs) by label, only considering the labels provided. Items without any label are
+    grouped under the `None` key.
+    """
+    labels = set(labels)
+    label_sorted_items = defaultdict(list)
+    for item in items:
+        if not item['labels']:
+            label_sorted_items[None].append(item)
+        for label in item['labels']:
+            if label['name'] in labels:
+                label_sorted_items[label['name']].append(item)
+    return label_sorted_items
+
+
+@dataclass(frozen=True)
+class RepoConfig:
+    """
+    Changelog customizations of a repo: the line generator, the labels used to group PRs and the header
+    labels used to group them into sections (if any).
+    """
+    generator: Callable
+    labels: Tuple[Optional[str], ...]
+    header_labels: Tuple[str, ...] = ()
+
+
 def get_custom_options(repo):
     """
     If repo has customizations defined for changelog use them, otherwise use defaults.
     """
-    if repo not in options:
-        repo = 'default'
+    return options.get(repo, options['default'])
+
+
+# layout of a changelog line, without and with PR labels in front of it
+LINE_TEMPLATE = " - {title}. {compat}[View pull request]({url})\n"
+LABELLED_LINE_TEMPLATE = " - **{labels}**: {title}. {compat}[View pull request]({url})\n"
+
+# message added to the changelog lines of PRs with the 'compatibility' label
+COMPAT_MSG = "**WARNING: Breaks compatibility with previous version.** "
+
+# prefix of the labels added in front of the changelog lines for the sct and ST projects
+SCT_LABEL_PREFIX = "sct_"
+ST_LABEL_PREFIX = "st_"
+
+# sort key used in place of the prefixed labels for PRs without any
+NO_PREFIX_LABELS = ('x',)
 
-    generator, labels, header_labels = options[repo]['generator'], options[repo]['labels'], options[repo].get('header_labels')
-    return generator, labels, header_labels
 
+def label_names(item):
+    """
+    Return the set of label names of an item (PR).
+    """
+    return {l['name'] for l in item['labels']}
 
-def default_changelog_generator(items):
+
+def default_changelog_generator(items, urls=None):
     """
     Contruct the default changelog line for a given item (PR).
+    The urls of the items are added to urls, if provided.
     """
+    if urls is None:
+        urls = set()
     lines = []
+    append = lines.append
+    format_line = LINE_TEMPLATE.format
     for item in items:
-        title = item['title']
-        breaks_compat = any(l['name'] == 'compatibility' for l in item['labels'])
-        pr_url = item['html_url']
-
-        if breaks_compat:
-            compat_msg = "**WARNING: Breaks compatibility with previous version.** "
-        else:
-            compat_msg = ""
+        urls.add(item['html_url'])
+        names = label_names(item)
+        compat_msg = COMPAT_MSG if 'compatibility' in names else ""
 
-        lines.append(f" - {title}. {compat_msg}[View pull request]({pr_url})\n")
+        append(format_line(title=item['title'], compat=compat_msg, url=item['html_url']))
     return lines
 
 
@@ -230,65 +521,81 @@ def default_header_changelog_generator(items, labels, line_generator):
             "\n",
             f"**{label_used.upper()}**\n",
         ])
-        lines.extend(line_generator(label_sorted_items[label_used]))
-        changelog_pr = changelog_pr.union(pr['html_url'] for pr in label_sorted_items[label_used])
+        # the urls are collected by the line generator
+        lines.extend(line_generator(label_sorted_items[label_used], changelog_pr))
     return lines, changelog_pr
 
 
-def sct_changelog_generator(items):
+def prefixed_changelog_generator(prefix):
     """
-    Custom changelog line generator for sct project.
+    Return a custom changelog line generator, which adds the PR labels starting with prefix (the CLI
+    functions changed by the PR) in front of the lines and sorts the lines by these labels.
+    Like the default generator, it adds the urls of the items to urls, if provided.
     """
-    lines = []
-    for item in items:
-        title = item['title']
-        sct_labels = sorted(l['name'] for l in item['labels'] if "sct_" in l['name'])
-        breaks_compat = any(l['name'] == 'compatibility' for l in item['labels'])
-        pr_url = item['html_url']
+    format_labelled_line = LABELLED_LINE_TEMPLATE.format
+    format_line = LINE_TEMPLATE.format
+    sort_key = operator.itemgetter(0, 1)
+
+    def changelog_generator(items, urls=None):
+        if urls is None:
+            urls = set()
+        lines = []
+        append = lines.append
+        for item in items:
+            urls.add(item['html_url'])
+            names = label_names(item)
+            compat_msg = COMPAT_MSG if 'compatibility' in names else ""
+            prefix_labels = tuple(sorted(n for n in names if n.startswith(prefix)))
+
+            if prefix_labels:
+                line = format_labelled_line(labels=', '.join(prefix_labels), title=item['title'],
+                                            compat=compat_msg, url=item['html_url'])
+            else:
+                line = format_line(title=item['title'], compat=compat_msg, url=item['html_url'])
+            # Sorting precedence: 1. PR labels > 2. PR number (unique, so the lines are never compared)
+            # NB: CLI PRs (e.g. `sct_function`) are ordered before API PRs (denoted using 'x')
+            append((prefix_labels or NO_PREFIX_LABELS, item['number'], line))
+        lines.sort(key=sort_key)
+        return [line for (pr_labels, pr_number, line) in lines]
 
-        if breaks_compat:
-            compat_msg = "**WARNING: Breaks compatibility with previous version.** "
-        else:
-            compat_msg = ""
+    return changelog_generator
 
-        if sct_labels:
-            labels_msg = f"**{', '.join(l for l in sct_labels)}**: "
-        else:
-            labels_msg = ""
 
-        line = f" - {labels_msg}{title}. {compat_msg}[View pull request]({pr_url})\n"
-        # Sorting precedence: 1. PR labels > 2. PR number > 3. Line contents
-        # NB: CLI PRs (`sct_function`) are ordered before API PRs (denoted using 'x')
-        lines.append((sct_labels if sct_labels else ['x'], item['number'], line))
-    return [line for (pr_labels, pr_number, line) in sorted(lines)]
+# Custom changelog line generators for sct and ST projects
+sct_changelog_generator = prefixed_changelog_generator(SCT_LABEL_PREFIX)
+st_changelog_generator = prefixed_changelog_generator(ST_LABEL_PREFIX)
 
 
-def st_changelog_generator(items):
+def changelog_section_lines(label_sorted_items, labels, header_labels, generator, changelog_pr):
     """
-    Custom changelog line generator for ST project.
+    Yield the lines of the changelog sections, with PRs grouped by header label if any, by label
+    otherwise. The urls of the PRs written in the changelog are added to changelog_pr.
     """
-    lines = []
-    for item in items:
-        title = item['title']
-        st_labels = sorted(l['name'] for l in item['labels'] if "st_" in l['name'])
-        breaks_compat = any(l['name'] == 'compatibility' for l in item['labels'])
-        pr_url = item['html_url']
-
-        if breaks_compat:
-            compat_msg = "**WARNING: Breaks compatibility with previous version.** "
-        else:
-            compat_msg = ""
-
-        if st_labels:
-            labels_msg = f"**{', '.join(l for l in st_labels)}**: "
-        else:
-            labels_msg = ""
+    # labels without any PR in the milestone are skipped
+    if header_labels:
+        for header_label in header_labels:
+            items = label_sorted_items.get(header_label)
+            if not items:
+                continue
+
+            # If a single header is given as an input, don't add H3
+            if header_label and len(header_labels) >= 2:
+                yield "\n"
+                yield f"### {header_label.upper()}\n"
+
+            some_lines, some_changelog_pr = default_header_changelog_generator(items, labels, generator)
+            yield from some_lines
+            changelog_pr.update(some_changelog_pr)
+    else:
+        for label in labels:
+            items = label_sorted_items.get(label)
+            if not items:
+                continue
 
-        line = f" - {labels_msg}{title}. {compat_msg}[View pull request]({pr_url})\n"
-        # Sorting precedence: 1. PR labels > 2. PR number > 3. Line contents
-        # NB: CLI PRs (`st_function`) are ordered before API PRs (denoted using 'x')
-        lines.append((st_labels if st_labels else ['x'], item['number'], line))
-    return [line for (pr_labels, pr_number, line) in sorted(lines)]
+            if label:
+                yield "\n"
+                yield f"**{label.upper()}**\n"
+            yield from generator(items, changelog_pr)
 
 
 def get_parser():
@@ -348,6 +655,12 @@ def get_parser():
         help="Use the milestone due date as the release date, instead of today.",
     )
 
+    optional.add_argument(
+        "--no-cache",
+        action='store_true',
+        help=f"Don't use the cache of the API responses (stored in '{CACHE_DIRECTORY}').",
+    )
+
     return parser
 
 
@@ -358,7 +671,7 @@ def main():
     logging.basicConfig(stream=sys.stdout, level=args.log_level, format="%(levelname)s %(message)s")
 
     repo_url = getattr(args, 'repo-url')
-    api = GithubAPI(repo_url=repo_url)
+    api = GithubAPI(repo_url=repo_url, use_cache=not args.no_cache)
     user, repo = repo_url.split('/')
 
     if args.milestone is not None:
@@ -373,90 +686,93 @@ def main():
     else:
         date = datetime.date.today()
 
-    lines = [
-        f"## {tag} ({date})\n",
-        f"[View detailed changelog]({api.get_tags_compare_url(tag)})\n",
-    ]
-
-    changelog_pr = set()
-    generator, labels, header_labels = get_custom_options(repo)
+    config = get_custom_options(repo)
+    generator, labels, header_labels = config.generator, config.labels, config.header_labels
     if args.labels is not None:
         labels = args.labels
     if args.header_labels is not None:
         header_labels = args.header_labels
-    if header_labels is None:
-        header_labels = []
 
-    if header_labels:
-        for header_label in header_labels:
-            items = api.search(milestone['title'], header_label)
-            if items:
-                # If a single header is given as an input, don't add H3
-                if header_label and len(header_labels) >= 2:
-                    lines.extend([
-                        "\n",
-                        f"### {header_label.upper()}\n",
-                    ])
-
-                some_lines, some_changelog_pr = default_header_changelog_generator(items, labels, generator)
-                lines.extend(some_lines)
-                changelog_pr.update(some_changelog_pr)
-    else:
-        for label in labels:
-            items = api.search(milestone['title'], label)
-            if items:
-                if label:
-                    lines.extend([
-                        "\n",
-                        f"**{label.upper()}**\n",
-                    ])
-                changelog_pr.update(pr['html_url'] for pr in items)
-                lines.extend(generator(items))
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # look up the previous release while the pull requests are fetched
+        compare_url = executor.submit(api.get_tags_compare_url, tag)
 
-    logger.info('Total number of pull requests with label: %d', len(changelog_pr))
-    all_pr = set(pr['html_url'] for pr in api.search(milestone['title']))
-    diff_pr = all_pr - changelog_pr
-    for diff in diff_pr:
-        logger.warning('Pull request not labeled: %s', diff)
+        # pull requests are grouped by header label if any, by label otherwise
+        group_labels = header_labels if header_labels else labels
+        if api.authenticated:
+            items = api.fetch_milestone_prs_graphql(milestone)
+        else:
+            # the GraphQL API requires authentication, fall back on the search API (a single search, without
+            # label filter: like with GraphQL, the PRs without any label are found while grouping them)
+            items = api.search(milestone['title'])
+        label_sorted_items = sort_by_label(items, group_labels)
+
+    # the changelog lines are generated while they are written to the file
+    changelog_pr = set()
+    lines = itertools.chain(
+        [f"## {tag} ({date})\n", f"[View detailed changelog]({compare_url.result()})\n"],
+        changelog_section_lines(label_sorted_items, labels, header_labels, generator, changelog_pr),
+    )
 
     if args.update:
         filename = args.name
         if not os.path.exists(filename):
             raise IOError(f"The provided changelog file: {filename} does not exist!")
 
-        with open(filename, 'r') as f:
-            original = f.readlines()
-
+        # the new changelog is written to a temporary file, so that the existing one stays untouched
+        # until the new one is complete
+        tmp_filename = f"{filename}.tmp"
+        try:
+            with open(filename, 'rb') as original, \
+                    open(tmp_filename, 'wb', buffering=WRITE_BUFFER_SIZE) as changelog:
+                # re-use first line from existing file since it most likely contains the title, then write
+                # current changelog with the same line endings as the existing file
+                first_line = original.readline()
+                newline = b"\r\n" if first_line.endswith(b"\r\n") else b"\n"
+                changelog.writelines(itertools.chain(
+                    [first_line, newline],
+                    (line.encode('utf-8').replace(b"\n", newline) for line in lines),
+                ))
+
+                # write back rest of changelog, without loading it all in memory
+                shutil.copyfileobj(original, changelog, COPY_BUFFER_SIZE)
+
+                changelog.flush()
+                os.fsync(changelog.fileno())
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+        # the backup is a copy, so that the changelog file exists at all times
         backup = f"{filename}.bak"
-        os.rename(filename, backup)
+        shutil.copy2(filename, backup)
         logger.info(f"Backup created: {backup}")
-
-        with open(filename, 'w') as changelog:
-            # re-use first line from existing file since it most likely contains the title
-            changelog.writelines(original[:1] + ["\n"])
-
-            # write current changelog
-            changelog.writelines(lines)
-
-            # write back rest of changelog
-            changelog.writelines(original[1:])
+        os.replace(tmp_filename, filename)
 
     else:
         filename = f"{user}_{repo}_changelog.{milestone['number']}.md"
-        with open(filename, "w") as changelog:
+        with open(filename, "w", buffering=WRITE_BUFFER_SIZE, encoding="utf-8") as changelog:
             changelog.writelines(lines)
 
+    logger.info('Total number of pull requests with label: %d', len(changelog_pr))
+    # only the PRs without any label are reported, PRs with other labels are left out on purpose
+    unlabeled_pr = set(pr['html_url'] for pr in label_sorted_items.get(None, ()))
+    diff_pr = unlabeled_pr - changelog_pr
+    for diff in diff_pr:
+        logger.warning('Pull request not labeled: %s', diff)
+
     logger.info(f"Changelog written into {filename}")
 
 
 # provides customization to changelog for some repos
-options = {
-    'default': {
-        'labels': [None],
-        'generator': default_changelog_generator,
-    },
-    'spinalcordtoolbox': {
-        'labels': [
+options = types.MappingProxyType({
+    'default': RepoConfig(
+        labels=(None,),
+        generator=default_changelog_generator,
+    ),
+    'spinalcordtoolbox': RepoConfig(
+        labels=(
             'feature',
             'enhancement',
             'bug',
@@ -466,11 +782,11 @@ options = {
             'refactoring',
             'CI',
             'git/github',
-        ],
-        'generator': sct_changelog_generator,
-    },
-    'ivadomed': {
-        'labels': [
+        ),
+        generator=sct_changelog_generator,
+    ),
+    'ivadomed': RepoConfig(
+        labels=(
             'feature',
             'CI',
             'bug',
@@ -480,22 +796,22 @@ options = {
             'enhancement',
             'testing',
             'refactoring',
-        ],
-        'generator': default_changelog_generator,
-    },
-    'axondeepseg': {
-        'labels': [
+        ),
+        generator=default_changelog_generator,
+    ),
+    'axondeepseg': RepoConfig(
+        labels=(
             'feature',
             'bug',
             'installation',
             'documentation',
             'enhancement',
             'testing',
-        ],
-        'generator': default_changelog_generator,
-    },
-    'shimming-toolbox': {
-        'labels': [
+        ),
+        generator=default_changelog_generator,
+    ),
+    'shimming-toolbox': RepoConfig(
+        labels=(
             'feature',
             'bug',
             'installation',
@@ -503,15 +819,15 @@ options = {
             'enhancement',
             'testing',
             'refactoring',
-        ],
-        'header_labels': [
+        ),
+        header_labels=(
             'Package: Shimming Toolbox',
             'Package: Plugin',
             'Repo',
-        ],
-        'generator': st_changelog_generator,
-    },
-}
+        ),
+        generator=st_changelog_generator,
+    ),
+})
 
 if __name__ == '__main__':
     raise SystemExit(main())
@@ -24,7 +24,7 @@ setup(
         'Programming Language :: Python :: 3.7',
     ],
     keywords='',
-    install_requires=['requests'],
+    install_requires=['requests', 'orjson'],
     packages=find_packages(exclude=['.git']),
     include_package_data=True,
     entry_points={